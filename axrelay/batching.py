@@ -0,0 +1,191 @@
+import logging
+import Queue
+import socket
+import ssl
+import threading
+import time
+from collections import Counter
+
+from sleekxmpp.xmlstream import tostring
+
+"""
+This module defines helpers for handling stanzas in batches
+on a background thread rather than one at a time on the
+stream's handler thread.
+"""
+
+log = logging.getLogger(__name__)
+
+# queued to stop a Batcher's thread
+_STOP = object()
+
+
+class Batcher(object):
+
+    """
+    collects items queued from any thread and hands them to
+    a flush callback in batches, from a single background
+    thread, in the order they were queued.
+
+    a batch is flushed once it reaches max_size (as measured
+    by sizeof) or once nothing more has been queued latency
+    seconds after its first item.
+    """
+
+    def __init__(self, name, flush, latency, max_size, sizeof=None):
+        """
+        :param name: names the thread and the log messages
+        :param flush: called with each batch, a list of items
+        :param latency: the most seconds to wait for more items
+                        once a batch has been started
+        :param max_size: the size at which a batch is flushed
+                         without waiting
+        :param sizeof: measures an item, items count as 1 by default
+        """
+        self.name = name
+        self.flush = flush
+        self.latency = latency
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda item: 1)
+
+        self.queue = Queue.Queue()
+        self.thread = None
+
+        # batches, items and total size flushed, and a histogram
+        # of items per batch in power of 2 buckets
+        self.stats = Counter()
+        self.batch_sizes = Counter()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(name=self.name, target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        flushes everything queued so far and stops the thread.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def prepare(self, item):
+        """
+        transforms each item on the batching thread before it
+        is measured and added to a batch.
+
+        Meant to be overridden.
+        """
+        return item
+
+    def format_stats(self):
+        return ", ".join(
+            ["%s=%d" % (k, v) for k, v in sorted(self.stats.items())] +
+            ["batch<=%d:%d" % (k, v) for k, v in sorted(self.batch_sizes.items())])
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+
+            batch = []
+            size = 0
+            deadline = time.time() + self.latency
+            while True:
+                item = self.prepare(item)
+                batch.append(item)
+                size += self.sizeof(item)
+                if size >= self.max_size:
+                    break
+
+                # whatever is queued already joins the batch even
+                # once the deadline has passed.
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        item = self.queue.get(timeout=timeout)
+                    else:
+                        item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+
+            self._flush(batch, size)
+
+    def _flush(self, batch, size):
+        self.stats['batches'] += 1
+        self.stats['items'] += len(batch)
+        self.stats['size'] += size
+        self.batch_sizes[1 << (len(batch) - 1).bit_length()] += 1
+        try:
+            self.flush(batch)
+        except Exception:
+            log.exception("%s: error flushing a batch of %d" %
+                          (self.name, len(batch)))
+
+
+class OutboundWriter(Batcher):
+
+    """
+    serializes outbound stanzas off the handler thread and
+    writes them to the stream in batches, so that bursts go
+    out in a few large socket writes instead of one write
+    per stanza.
+    """
+
+    def __init__(self, xmpp, latency, max_bytes, requeue):
+        """
+        :param xmpp: the stream to write to
+        :param latency: the most seconds a stanza waits for others
+                        to share its write
+        :param max_bytes: the (approximate) batch size at which the
+                          batch is written without waiting
+        :param requeue: called with the stanzas of a batch that
+                        couldn't be written, in order
+        """
+        Batcher.__init__(self, "%s outbound" % xmpp.boundjid.bare,
+                         self.write, latency, max_bytes,
+                         sizeof=lambda item: len(item[1]))
+        self.xmpp = xmpp
+        self.requeue = requeue
+
+    def prepare(self, stanza):
+        return (stanza, tostring(stanza.xml, xmlns=self.xmpp.default_ns,
+                                 stream=self.xmpp, top_level=True))
+
+    def write(self, batch):
+        stanzas = [stanza for stanza, data in batch]
+        if not self.xmpp.session_started_event.is_set():
+            self.requeue(stanzas)
+            return
+
+        # the batch is written here rather than queued with
+        # XMLStream.send()/send_raw(): sleekxmpp forgets a queued
+        # write that fails once it reconnects, and its send thread
+        # doesn't survive the failure.  This deliberately skips the
+        # stream's out/out_sync filters, relayed stanzas are never
+        # seen by them.
+        data = u"".join(data for stanza, data in batch).encode('utf-8')
+        try:
+            with self.xmpp.send_lock:
+                self.xmpp.socket.sendall(data)
+        except (socket.error, ssl.SSLError) as e:
+            self.stats['failed'] += 1
+            log.warn("%s: failed writing %d stanzas, requeueing them" %
+                     (self.name, len(stanzas)))
+            self.xmpp.event('socket_error', e, direct=True)
+            if not self.xmpp.stop.is_set():
+                self.xmpp.disconnect(self.xmpp.auto_reconnect,
+                                     send_close=False)
+            self.requeue(stanzas)
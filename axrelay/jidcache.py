@@ -0,0 +1,126 @@
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+from sleekxmpp.xmlstream import JID
+
+"""
+This module defines an interning cache for the JIDs seen on
+the hot path of the relay.
+
+Parsing a JID runs a regex and stringprep normalization,
+while the same few thousand JIDs repeat constantly as
+conversations go back and forth.  The cache keeps the parsed
+JIDs (keyed by their string) and the anonymous JIDs hashed
+from them (keyed by the secret, domain and real jid) so that
+repeat conversations skip parsing, normalization and hashing.
+
+The cached JIDs are shared, they must not be modified.
+"""
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# rough per entry cost of the OrderedDict bookkeeping
+ENTRY_OVERHEAD = 200
+
+
+class JIDCache(object):
+
+    """
+    a thread safe LRU cache of JIDs bounded by the
+    approximate memory held by its entries.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param max_bytes: the approximate memory the cached entries
+                          may hold before the least recently used
+                          are evicted.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # hits and misses by kind of entry, "parsed" or "hashed"
+        self.hits = Counter()
+        self.misses = Counter()
+        self.lock = threading.Lock()
+
+    def jid(self, value):
+        """
+        :returns: the JID parsed from the string given, parsing
+                  it only if it isn't cached already.
+        """
+        jid = self.get(value, "parsed")
+        if jid is None:
+            jid = JID(value)
+            self.put(value, jid)
+        return jid
+
+    def get(self, key, kind):
+        """
+        :param kind: the kind of entry looked up, hits and misses
+                     are counted per kind.
+        :returns: the cached JID for the key given or None
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses[kind] += 1
+                return None
+            # re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits[kind] += 1
+            return entry[0]
+
+    def put(self, key, jid):
+        size = sizeof_entry(key, jid)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (jid, size)
+            self.bytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+            }
+            for kind in set(self.hits) | set(self.misses):
+                stats['%s_hits' % kind] = self.hits[kind]
+                stats['%s_misses' % kind] = self.misses[kind]
+            return stats
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.entries:
+            key, (jid, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+
+def sizeof_entry(key, jid):
+    """
+    approximates the memory held by a cache entry: the key,
+    the JID and its parts.
+    """
+    size = ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(jid)
+    if isinstance(key, tuple):
+        size += sum(sys.getsizeof(k) for k in key)
+    for part in (jid.user, jid.domain, jid.resource):
+        size += sys.getsizeof(part)
+    return size
+
+
+# the cache shared by jidhash and every relay in the process
+jid_cache = JIDCache()
@@ -7,6 +7,8 @@ import sys
 from Crypto import Random
 from sleekxmpp.xmlstream import JID
 
+from jidcache import jid_cache
+
 log = logging.getLogger(__name__)
 
 
@@ -34,7 +36,7 @@ def secret_hash(name, secret):
     return base64.b32encode(h.digest()).replace("=", "").lower()
 
 
-def hash_jid(jid, secret, domain, storage):
+def hash_jid(jid, secret, domain, storage, cache=jid_cache):
     """
     transforms the given jid into an anonymized version
     and stores the mapping from anonymized jid -> jid in the
@@ -47,6 +49,7 @@ def hash_jid(jid, secret, domain, storage):
     :param domain: the domain that the anonymous jids belong to.
     :param storage: where to store the mapping between anonymous and real jid,
                     must have set and get method.
+    :param cache: the JIDCache holding previously hashed jids.
 
     :returns: a JID that is the anonymous alias of the JID given
     """
@@ -58,8 +61,7 @@ def hash_jid(jid, secret, domain, storage):
         log.debug("hash_jid: %s => %s" % (jid, jid))
         return jid
     else:
-        secret_name = secret_hash(jid.full, secret)
-        hashed_jid = JID('%s@%s/a' % (secret_name, domain))
+        hashed_jid = anonymous_jid(jid, secret, domain, cache)
 
         # store the hashed jid using the bare portion of the
         # jid, we don't really care about the resource.
@@ -70,13 +72,58 @@ def hash_jid(jid, secret, domain, storage):
         return hashed_jid
 
 
-def lookup_jid(hashed_jid, storage):
+def hash_jids(jids, secret, domain, storage, cache=jid_cache):
+    """
+    hash_jid for several jids at once.  each distinct jid is
+    hashed once and all of the new mappings are stored with a
+    single set_multi.
+
+    :returns: a dict from the full form of each JID given to its
+              anonymous alias
+    """
+    hashed = {}
+    mappings = {}
+    for jid in jids:
+        if jid is None or jid.full in hashed:
+            continue
+
+        # already anonymous
+        if (jid.domain == domain):
+            hashed[jid.full] = jid
+        else:
+            hashed_jid = anonymous_jid(jid, secret, domain, cache)
+            hashed[jid.full] = hashed_jid
+            mappings[hashed_jid.bare] = jid.full
+
+    if mappings:
+        storage.set_multi(mappings)
+
+    log.debug("hash_jids: %d jids, %d stored" % (len(hashed), len(mappings)))
+    return hashed
+
+
+def anonymous_jid(jid, secret, domain, cache=jid_cache):
+    """
+    :returns: the anonymous JID for the given jid, from the cache
+              when it was hashed before.
+    """
+    cache_key = (secret, domain, jid.full)
+    hashed_jid = cache.get(cache_key, "hashed")
+    if hashed_jid is None:
+        secret_name = secret_hash(jid.full, secret)
+        hashed_jid = JID('%s@%s/a' % (secret_name, domain))
+        cache.put(cache_key, hashed_jid)
+    return hashed_jid
+
+
+def lookup_jid(hashed_jid, storage, cache=jid_cache):
     """
     look up the real jid of a previously generated
     anonymous jid in the storage backend given.
 
     :param hashed_jid: the hashed JID to lookup
     :param storage: the storage backend to use
+    :param cache: the JIDCache used to parse the real jid
 
     :returns: the real JID associated with the given JID or None
               if there is no known mapping.
@@ -89,11 +136,27 @@ def lookup_jid(hashed_jid, storage):
 
     log.debug("lookup_jid: %s => %s" % (hashed_jid, real_jid))
     if real_jid is not None:
-        return JID(real_jid)
+        return cache.jid(real_jid)
     else:
         return None
 
 
+def lookup_jids(hashed_jids, storage, cache=jid_cache):
+    """
+    lookup_jid for several jids at once, with a single get_multi
+    for the distinct bare jids given.
+
+    :returns: a dict from the bare form of each JID given to its
+              real JID, jids without a known mapping are left out.
+    """
+    keys = set(hashed_jid.bare for hashed_jid in hashed_jids)
+    real_jids = storage.get_multi(list(keys))
+
+    log.debug("lookup_jids: %d jids, %d found" % (len(keys), len(real_jids)))
+    return dict((key, cache.jid(real_jid))
+                for key, real_jid in real_jids.items())
+
+
 def new_secret():
     """
     creates a new storage secret suitable for the hash secret
@@ -120,7 +183,8 @@ def hash_main(argv):
     """
 
     from cli import build_base_options, parse_config
-    from jidstorage import build_storage, no_storage
+    from jidstorage import (build_storage, domain_storage, hash_section,
+                            no_storage)
 
     optparser = build_base_options()
 
@@ -131,10 +195,20 @@ def hash_main(argv):
         "-l", "--lookup", help='lookup real jid for hashed jid',
         dest="lookup", action="store_true", default=False)
 
+    optparser.add_option(
+        "--domain", help='use the [hash:NAME] section of an additional domain',
+        dest="domain", metavar="NAME", default=None)
+
     opts, args, config = parse_config(argv, optparser)
 
+    section = hash_section(opts.domain)
+    if opts.domain is not None and not config.has_section(section):
+        sys.exit("Configuration file %s is missing the [%s] section" % (
+            opts.config_file, section))
+
     if opts.build_storage == True or opts.lookup:
-        storage = build_storage(config, opts)
+        storage = domain_storage(
+            config, build_storage(config, opts), opts.domain)
     else:
         storage = no_storage()
 
@@ -144,7 +218,6 @@ def hash_main(argv):
             print "%s => %s" % (hjid, real_jid)
 
     else:
-        section = "hash"
         if not config.has_section(section):
             sys.exit("Configuration file %s is missing the [%s] section" % (
                 opts.config_file, section))
@@ -17,6 +17,8 @@ Currently the interface for a storage backend is:
 * set(key, val)
 * get(key)  : returns None if key is not present
 * delete(key)
+* set_multi(mapping) : sets every key/value in the dict given
+* get_multi(keys) : returns a dict of the keys present
 """
 
 
@@ -24,6 +26,7 @@ log = logging.getLogger(__name__)
 
 MEMCACHE_SECTION = "memcache"
 LOCAL_SECTION = "local_storage"
+HASH_SECTION = "hash"
 
 
 class NoStorage(object):
@@ -41,6 +44,12 @@ class NoStorage(object):
     def delete(self, key):
         pass
 
+    def get_multi(self, keys):
+        return {}
+
+    def set_multi(self, mapping):
+        pass
+
 
 class LocalStorage(dict):
 
@@ -56,6 +65,12 @@ class LocalStorage(dict):
     def delete(self, key):
         del self[key]
 
+    def get_multi(self, keys):
+        return dict((key, self[key]) for key in keys if key in self)
+
+    def set_multi(self, mapping):
+        self.update(mapping)
+
 
 class MemcacheStorage(object):
 
@@ -86,6 +101,18 @@ class MemcacheStorage(object):
         with self.pool.reserve() as mc:
             mc.delete(self._pack_key(key))
 
+    def get_multi(self, keys):
+        packed = dict((self._pack_key(key), key) for key in keys)
+        with self.pool.reserve() as mc:
+            vals = mc.get_multi(packed.keys())
+        return dict((packed[k], self._unpack_val(v)) for k, v in vals.items())
+
+    def set_multi(self, mapping):
+        with self.pool.reserve() as mc:
+            return mc.set_multi(dict(
+                (self._pack_key(k), self._pack_val(v))
+                for k, v in mapping.items()))
+
     def _pack_key(self, key):
         if key is None:
             return None
@@ -102,6 +129,45 @@ class MemcacheStorage(object):
         return base64.b64decode(val)
 
 
+class NamespacedStorage(object):
+
+    """
+    This storage wraps a storage and prefixes every key with
+    a namespace, so several relay domains can share one
+    backend (and its connection pool) without their
+    mappings colliding.
+    """
+
+    def __init__(self, storage, namespace):
+        """
+        :param storage: the actual storage to store the data in
+        :param namespace: the prefix to add to every key
+        """
+        self.storage = storage
+        self.namespace = namespace
+
+    def set(self, key, value):
+        return self.storage.set(self._ns_key(key), value)
+
+    def get(self, key):
+        return self.storage.get(self._ns_key(key))
+
+    def delete(self, key):
+        return self.storage.delete(self._ns_key(key))
+
+    def get_multi(self, keys):
+        ns_keys = dict((self._ns_key(key), key) for key in keys)
+        vals = self.storage.get_multi(ns_keys.keys())
+        return dict((ns_keys[k], v) for k, v in vals.items())
+
+    def set_multi(self, mapping):
+        return self.storage.set_multi(dict(
+            (self._ns_key(k), v) for k, v in mapping.items()))
+
+    def _ns_key(self, key):
+        return "%s:%s" % (self.namespace, key)
+
+
 class NonEnumerableStorage(object):
 
     """
@@ -168,6 +234,17 @@ class NonEnumerableStorage(object):
     def delete(self, key):
         return self.storage.delete(self._hash_key(key))
 
+    def get_multi(self, keys):
+        hashed_keys = dict((self._hash_key(key), key) for key in keys)
+        vals = self.storage.get_multi(hashed_keys.keys())
+        return dict((hashed_keys[k], self._decrypt(hashed_keys[k], v))
+                    for k, v in vals.items())
+
+    def set_multi(self, mapping):
+        return self.storage.set_multi(dict(
+            (self._hash_key(k), self._encrypt(k, v))
+            for k, v in mapping.items()))
+
     def _hash_key(self, key):
         return secret_hash(key, self.secret)
 
@@ -244,6 +321,38 @@ def build_storage(config, opts):
     return storage
 
 
+def hash_section(name=None):
+    """
+    :returns: the name of the [hash] section, or of the
+              [hash:<name>] section of an additional domain.
+    """
+    if name is None:
+        return HASH_SECTION
+    return "%s:%s" % (HASH_SECTION, name)
+
+
+def domain_storage(config, storage, name=None):
+    """
+    wraps the storage given in the key namespace of a domain,
+    so that domains sharing a backend can never see each
+    other's mappings.
+
+    the namespace is the "namespace" option of the domain's
+    hash section, or the domain's name.  the [hash] domain is
+    not namespaced unless configured to be.
+
+    :param name: the name of an additional domain, None for [hash]
+    """
+    namespace = name
+    section = hash_section(name)
+    if config.has_option(section, "namespace"):
+        namespace = config.get(section, "namespace")
+
+    if namespace:
+        storage = NamespacedStorage(storage, namespace)
+    return storage
+
+
 def no_storage():
     """
     creates a dummy storage backend that does nothing
@@ -1,17 +1,26 @@
 import sleekxmpp
 from sleekxmpp.componentxmpp import ComponentXMPP
+from sleekxmpp.jid import InvalidJID
+from sleekxmpp.stanza import StreamError
 from sleekxmpp.xmlstream import JID
 
 import copy
 import logging
 import re
 import sys
+import threading
+import time
+from collections import Counter, deque
 
-from jidhash import hash_jid, lookup_jid
-from jidstorage import build_storage
+from batching import Batcher, OutboundWriter
+from jidcache import jid_cache
+from jidhash import hash_jid, hash_jids, lookup_jids
+from jidstorage import build_storage, domain_storage, hash_section
 
 log = logging.getLogger(__name__)
 
+RELAY_SECTION = "relay"
+
 
 class AXRComponent(ComponentXMPP):
 
@@ -19,25 +28,173 @@ class AXRComponent(ComponentXMPP):
     An anonymous xmpp relay component
     """
 
-    def __init__(self, jid, password, server, port, secret, domain, storage):
+    def __init__(self, jid, password, server, port, secret, domain, storage,
+                 stats_interval=0, reconnect_delay=0.1,
+                 reconnect_max_delay=30.0, outbound_buffer=1000,
+                 batch_latency=0.002, batch_bytes=16384,
+                 relay_window=0.005, relay_batch_size=100):
         """
         :param jid:      the jid of the component itself (bot)
         :param password: the server password to attach this component
         :param server:   the address of the jabber server to attach to
         :param secret:   the secret used to garble jids
         :param storage:  the storage backend to use to store jids
+        :param stats_interval: seconds between logging the relay counters,
+                               0 disables periodic logging
+        :param reconnect_delay: seconds to wait before the first attempt to
+                                reconnect a dropped stream, doubled after
+                                each failed attempt
+        :param reconnect_max_delay: the most seconds to wait between
+                                    attempts to reconnect
+        :param outbound_buffer: the most relayed stanzas to hold while the
+                                stream is down, the oldest are dropped
+                                beyond that
+        :param batch_latency: the most seconds a relayed stanza waits for
+                              others to share its socket write
+        :param batch_bytes: the size at which a batch of relayed stanzas
+                            is written without waiting
+        :param relay_window: the most seconds an incoming stanza waits for
+                             others to be resolved with it
+        :param relay_batch_size: the number of incoming stanzas that are
+                                 resolved without waiting
         """
         ComponentXMPP.__init__(self, jid, password, server, port)
         self.hash_secret = secret
         self.domain = domain
         self.name_lookup = storage
 
+        # per domain counters, see log_stats
+        self.stats = Counter()
+        if stats_interval > 0:
+            self.schedule("log stats", stats_interval, self.log_stats,
+                          repeat=True)
+
+        # the stream is reconnected whenever it drops, see disconnect.
+        # storage and caches live in this object, so they stay warm.
+        self.shutting_down = False
+        # the condition of a stream error not worth reconnecting after
+        self.stream_failed = None
+        self.reconnect_min_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.backoff(reconnect_delay)
+
+        # relayed stanzas held while the stream is down, sent
+        # on the next session_start
+        self.outbound = deque(maxlen=outbound_buffer)
+        # and those already handed to the writer that it couldn't
+        # write, sent again first
+        self.unwritten = deque()
+        self.outbound_lock = threading.Lock()
+
+        # relayed stanzas are serialized and written in batches
+        self.writer = OutboundWriter(self, batch_latency, batch_bytes,
+                                     self.requeue_outbound)
+
+        # incoming stanzas to relay are resolved in batches,
+        # see relay_messages
+        self.inbound = Batcher("%s inbound" % self.boundjid.bare,
+                               self.relay_messages, relay_window,
+                               relay_batch_size)
+
         self.bot_jid = JID(jid)
         # the specific resource the bot replies from
         self.specific_bot_jid = JID(jid)
         self.specific_bot_jid.resource = 'a'
 
         self.add_event_handler("message", self.message)
+        self.add_event_handler("session_start", self.session_start)
+        self.add_event_handler("disconnected", self.disconnected)
+        self.add_event_handler("socket_error", self.socket_error)
+
+    def session_start(self, event):
+        self.backoff(self.reconnect_min_delay)
+
+        with self.outbound_lock:
+            if self.unwritten or self.outbound:
+                log.info("%s: sending %d buffered stanzas" %
+                         (self.boundjid.bare,
+                          len(self.unwritten) + len(self.outbound)))
+            self.send_outbound()
+
+    def disconnected(self, event):
+        if not self.shutting_down and self.stream_failed is None:
+            self.stats['disconnects'] += 1
+            log.warn("%s: stream lost, reconnecting" % self.boundjid.bare)
+
+    # stream errors after which the server can be expected to take
+    # the component back, any other (not-authorized, host-unknown,
+    # conflict, ...) won't go away by reconnecting.
+    TRANSIENT_STREAM_ERRORS = frozenset([
+        'connection-timeout', 'internal-server-error',
+        'remote-connection-failed', 'reset', 'resource-constraint',
+        'see-other-host', 'system-shutdown'])
+
+    def incoming_filter(self, xml):
+        # stream errors are checked here, on the thread reading the
+        # stream, since the 'stream_error' event only runs once that
+        # thread has already gone on to reconnect.
+        if xml.tag == "{%s}error" % self.stream_ns:
+            self.check_stream_error(StreamError(xml=xml))
+        return ComponentXMPP.incoming_filter(self, xml)
+
+    def check_stream_error(self, error):
+        condition = error['condition']
+        description = condition
+        if error['text']:
+            description += " (%s)" % error['text']
+
+        if condition in self.TRANSIENT_STREAM_ERRORS:
+            log.warn("%s: stream error %s" % (self.boundjid.bare, description))
+            return
+
+        log.error("%s: stream error %s, not reconnecting" %
+                  (self.boundjid.bare, description))
+        self.stream_failed = condition
+        self.auto_reconnect = False
+
+    def socket_error(self, error):
+        # back off after each failed attempt to connect, the errors
+        # of a stream going down don't count.
+        if not self.state.ensure('connected'):
+            self.backoff(self.reconnect_backoff * 2)
+
+    def backoff(self, delay):
+        self.reconnect_backoff = min(delay, self.reconnect_max_delay)
+        # sleekxmpp waits about twice reconnect_delay before
+        # each connection attempt
+        self.reconnect_delay = self.reconnect_backoff / 2.0
+
+    def disconnect(self, reconnect=False, wait=None, send_close=True):
+        # sleekxmpp may give up on the stream after any stream error,
+        # e.g. when the server restarts. keep reconnecting unless
+        # we are shutting down or the error was permanent.
+        if not self.shutting_down and self.stream_failed is None:
+            reconnect = True
+        return ComponentXMPP.disconnect(self, reconnect, wait, send_close)
+
+    def reconnect(self, reattempt=True, wait=False, send_close=True):
+        # unless the server ended the stream, the connection dropped
+        # and there is nobody to close the stream with. don't wait
+        # (up to 4 seconds) for the server's end of stream.
+        if not self.stream_end_event.is_set():
+            send_close = False
+        return ComponentXMPP.reconnect(self, reattempt, wait, send_close)
+
+    def process(self, **kwargs):
+        self.writer.start()
+        self.inbound.start()
+        return ComponentXMPP.process(self, **kwargs)
+
+    def shutdown(self):
+        self.shutting_down = True
+        # relay whatever is batched, hand it to the stream and
+        # let the stream send it, before closing it
+        self.inbound.stop()
+        self.writer.stop()
+        self.disconnect(wait=self.session_started_event.is_set())
+        # disconnect does nothing unless connected, e.g. while
+        # reconnecting, so stop the stream's threads regardless.
+        self.set_stop()
 
     def message(self, msg):
         """
@@ -59,36 +216,126 @@ class AXRComponent(ComponentXMPP):
         # drop errors, groupchat and unknown
         mtype = msg.get('type')
         if mtype not in ('None', '', 'normal', 'chat'):
+            self.stats['ignored'] += 1
             return
 
         # is the message to this bot?
-        if (msg['to'].bare == self.bot_jid.bare):
+        if (self.stanza_jid(msg, 'to').bare == self.bot_jid.bare):
             return self.bot_command(msg)
         else:
-            return self.relay_message(msg)
+            return self.inbound.put(msg)
 
-    def relay_message(self, msg):
+    def relay_messages(self, msgs):
+        """
+        relays a batch of messages, in the order given.
 
-        relay_to = self.lookup_jid(msg['to'])
-        if relay_to is None:
-            log.warn("Couln't find a prior jid for %s" % msg['to'])
+        bursts (e.g. offline messages flushed when a client comes
+        online) repeat the same senders and destinations, so each
+        distinct destination is looked up and each distinct sender
+        hashed once for the whole batch.
+        """
+        # a message with a jid that doesn't parse is dropped on its
+        # own, not with the rest of the batch.
+        valid = []
+        for msg in msgs:
+            try:
+                valid.append((msg, self.stanza_jid(msg, 'to'),
+                              self.stanza_jid(msg, 'from')))
+            except InvalidJID as e:
+                log.warn("%s: dropping a message with an invalid jid: %s" %
+                         (self.boundjid.bare, e))
+                self.stats['failed'] += 1
+        if not valid:
             return
+        msgs, tos, froms = zip(*valid)
 
-        # the sender's jid is also garbled, so replies will thread back
-        # through the relay
-        relay_from = self.hash_jid(msg['from'])
+        try:
+            relay_tos = self.lookup_jids(tos)
+
+            # the sender's jid is also garbled, so replies will thread
+            # back through the relay
+            relay_froms = self.hash_jids(
+                [from_jid for from_jid, to_jid in zip(froms, tos)
+                 if to_jid.bare in relay_tos])
+        except Exception:
+            # e.g. the storage failing, or a value it can't decrypt.
+            # resolve each message on its own so that only the
+            # messages that fail again are lost.
+            if len(msgs) == 1:
+                log.exception("%s: error relaying a message to %s" %
+                              (self.boundjid.bare, tos[0]))
+                self.stats['failed'] += 1
+                return
+            log.exception("%s: error relaying a batch of %d messages, "
+                          "retrying them one at a time" %
+                          (self.boundjid.bare, len(msgs)))
+            for msg in msgs:
+                self.relay_messages([msg])
+            return
 
-        relay_msg = copy.copy(msg)
-        relay_msg['to'] = relay_to
-        relay_msg['from'] = relay_from
-        relay_msg.send()
+        for msg, to_jid, from_jid in zip(msgs, tos, froms):
+            relay_to = relay_tos.get(to_jid.bare)
+            if relay_to is None:
+                log.warn("Couln't find a prior jid for %s" % to_jid)
+                self.stats['unknown'] += 1
+                continue
+
+            try:
+                relay_msg = copy.copy(msg)
+                relay_msg['to'] = relay_to
+                relay_msg['from'] = relay_froms[from_jid.full]
+                self.send_relayed(relay_msg)
+            except Exception:
+                log.exception("%s: error relaying a message to %s" %
+                              (self.boundjid.bare, to_jid))
+                self.stats['failed'] += 1
+
+    def send_relayed(self, msg):
+        """
+        sends a relayed stanza, or holds it in the outbound buffer
+        while the stream is down.
+        """
+        with self.outbound_lock:
+            if (self.session_started_event.is_set() and
+                    not self.unwritten and not self.outbound):
+                self.writer.put(msg)
+                self.stats['relayed'] += 1
+                return
+
+            if len(self.outbound) == self.outbound.maxlen:
+                self.stats['dropped'] += 1
+            self.outbound.append(msg)
+            self.stats['buffered'] += 1
+
+    def requeue_outbound(self, msgs):
+        """
+        holds relayed stanzas the writer couldn't write, to be
+        sent again, ahead of the outbound buffer, once the
+        stream is back.
+        """
+        with self.outbound_lock:
+            self.unwritten.extend(msgs)
+            self.stats['relayed'] -= len(msgs)
+            self.stats['requeued'] += len(msgs)
+
+            # the stream may be back already
+            if self.session_started_event.is_set():
+                self.send_outbound()
+
+    def send_outbound(self):
+        # called holding outbound_lock
+        for buffer in (self.unwritten, self.outbound):
+            while buffer:
+                self.writer.put(buffer.popleft())
+                self.stats['relayed'] += 1
 
     WHOAMI = "/whoami"
 
     def bot_command(self, msg):
         cmd = msg.get('body', '').split(' ')
         if (cmd[0] == self.WHOAMI):
-            body = str(self.hash_jid(msg['from']).bare)
+            body = str(self.hash_jid(self.stanza_jid(msg, 'from')).bare)
+            self.stats['whoami'] += 1
 
             msg.reply(body)
             msg['from'] = self.specific_bot_jid
@@ -97,8 +344,26 @@ class AXRComponent(ComponentXMPP):
     def hash_jid(self, jid):
         return hash_jid(jid, self.hash_secret, self.domain, self.name_lookup)
 
-    def lookup_jid(self, jid):
-        return lookup_jid(jid, self.name_lookup)
+    def hash_jids(self, jids):
+        return hash_jids(jids, self.hash_secret, self.domain, self.name_lookup)
+
+    def lookup_jids(self, jids):
+        return lookup_jids(jids, self.name_lookup)
+
+    def stanza_jid(self, msg, attr):
+        # msg['to'] and msg['from'] parse a new JID on every access,
+        # go through the shared cache instead.
+        return jid_cache.jid(msg.xml.get(attr, ''))
+
+    def log_stats(self):
+        log.info("stats for %s: %s" % (self.boundjid.bare, ", ".join(
+            "%s=%d" % (k, v) for k, v in sorted(self.stats.items()))))
+        log.info("inbound batches for %s: %s" % (
+            self.boundjid.bare, self.inbound.format_stats()))
+        log.info("outbound writes for %s: %s" % (
+            self.boundjid.bare, self.writer.format_stats()))
+        log.info("jid cache: %s" % ", ".join(
+            "%s=%d" % (k, v) for k, v in sorted(jid_cache.stats().items())))
 
 
 def relay_main(argv):
@@ -106,30 +371,82 @@ def relay_main(argv):
     optparser = build_base_options()
     opts, args, config = parse_config(argv, optparser)
 
+    # a single storage backend (and its connection pool) is
+    # shared by every configured domain.
     storage = build_storage(config, opts)
-    xmpp = build_relay(config, opts, storage)
+    relays = build_relays(config, opts, storage)
 
-    # Connect to the XMPP server and start processing XMPP stanzas.
-    if xmpp.connect():
-        xmpp.process(block=True)
-        print("Done")
-    else:
+    # so is the jid cache
+    key = "jid_cache_bytes"
+    if config.has_option(RELAY_SECTION, key):
+        try:
+            jid_cache.resize(config.getint(RELAY_SECTION, key))
+        except ValueError:
+            sys.exit("option %s in section [%s] of %s must be an integer" %
+                     (key, RELAY_SECTION, opts.config_file))
+
+    # Connect to the XMPP server and start processing XMPP stanzas,
+    # one component stream per domain.
+    connected = [xmpp for xmpp in relays if xmpp.connect()]
+    if not connected:
         print("Unable to connect.")
+        return
 
+    for xmpp in connected:
+        xmpp.process(block=False)
 
-def build_relay(config, opts, storage):
-    section = "relay"
+    try:
+        while any(not xmpp.stop.is_set() for xmpp in connected):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for xmpp in connected:
+            xmpp.shutdown()
 
-    if not config.has_section(section):
-        sys.exit("Configuration file %s is missing the [%s] section" %
-                 (opts.config_file, section))
+    for xmpp in connected:
+        xmpp.log_stats()
+    print("Done")
 
-    relay_cfg = {}
-    for key in ["server", "password", "jid", "port"]:
-        if not config.has_option(section, key):
-            sys.exit('Missing option "%s" in [%s] section of %s' %
-                     (key, section, opts.config_file))
-        relay_cfg[key] = config.get(section, key)
+
+def build_relays(config, opts, storage):
+    """
+    builds the relay component configured in the [relay] and [hash]
+    sections, plus one for every additional [relay:<name>] and
+    [hash:<name>] pair of sections.
+
+    all of the relays share the storage backend given, each in its
+    own key namespace.
+    """
+    relays = [build_relay(config, opts, storage)]
+    for section in config.sections():
+        if section.startswith(RELAY_SECTION + ":"):
+            name = section.split(":", 1)[1]
+            relays.append(build_relay(config, opts, storage, name))
+
+    return relays
+
+
+def build_relay(config, opts, storage, name=None):
+    """
+    builds a relay component.
+
+    :param name: the name of an additional domain, selects the
+                 [relay:<name>] and [hash:<name>] sections. options
+                 other than jid missing from [relay:<name>] are taken
+                 from [relay].
+    """
+    if name is None:
+        section = RELAY_SECTION
+        defaults = None
+    else:
+        section = "%s:%s" % (RELAY_SECTION, name)
+        defaults = RELAY_SECTION
+    require_section(config, opts, section)
+
+    relay_cfg = {
+        "jid": get_option(config, opts, section, "jid"),
+    }
+    for key in ["server", "password", "port"]:
+        relay_cfg[key] = get_option(config, opts, section, key, defaults)
     for key in ["port"]:
         try:
             relay_cfg[key] = int(relay_cfg[key])
@@ -137,21 +454,63 @@ def build_relay(config, opts, storage):
             sys.exit("option %s in section [%s] of %s must be an integer" %
                      (key, section, opts.config_file))
 
-    section = "hash"
-    if not config.has_section(section):
-        sys.exit("Configuration file %s is missing the [%s] section" %
-                 (opts.config_file, section))
+    # optional settings, AXRComponent has the defaults
+    for key in ["stats_interval", "outbound_buffer", "batch_bytes",
+                "relay_batch_size"]:
+        value = get_option(config, opts, section, key, defaults, default=None)
+        if value is None:
+            continue
+        try:
+            relay_cfg[key] = int(value)
+        except:
+            sys.exit("option %s in section [%s] of %s must be an integer" %
+                     (key, section, opts.config_file))
+    for key in ["reconnect_delay", "reconnect_max_delay", "batch_latency",
+                "relay_window"]:
+        value = get_option(config, opts, section, key, defaults, default=None)
+        if value is None:
+            continue
+        try:
+            relay_cfg[key] = float(value)
+        except:
+            sys.exit("option %s in section [%s] of %s must be a number" %
+                     (key, section, opts.config_file))
+
+    section = hash_section(name)
+    require_section(config, opts, section)
 
     for key in ["secret", "domain"]:
-        if not config.has_option(section, key):
-            sys.exit('Missing option "%s" in [%s] section of %s' %
-                     (key, section, opts.config_file))
-        relay_cfg[key] = config.get(section, key)
+        relay_cfg[key] = get_option(config, opts, section, key)
 
-    relay_cfg['storage'] = storage
+    relay_cfg['storage'] = domain_storage(config, storage, name)
     xmpp = AXRComponent(**relay_cfg)
 
     return xmpp
 
+
+def require_section(config, opts, section):
+    if not config.has_section(section):
+        sys.exit("Configuration file %s is missing the [%s] section" %
+                 (opts.config_file, section))
+
+
+_REQUIRED = object()
+
+
+def get_option(config, opts, section, key, defaults=None, default=_REQUIRED):
+    """
+    reads an option from the section given, falling back to the
+    defaults section (if any) and then to the default value.
+    exits if the option is required and missing.
+    """
+    for s in [section, defaults]:
+        if s is not None and config.has_option(s, key):
+            return config.get(s, key)
+
+    if default is _REQUIRED:
+        sys.exit('Missing option "%s" in [%s] section of %s' %
+                 (key, section, opts.config_file))
+    return default
+
 if __name__ == "__main__":
     relay_main(sys.argv)